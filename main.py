@@ -1,49 +1,118 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
-from typing import List
-import redis
-import json
+from typing import Dict, List, Union
+import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+import msgspec
+import orjson
 import uuid
 import asyncio
+import itertools
 from datetime import datetime
 from enum import Enum
 import time
 from contextlib import asynccontextmanager
 
+# Upper bound on pooled Redis connections; keep it well below the server's `maxclients`
+REDIS_MAX_CONNECTIONS = 32
+
+# Accepted range for ingested IDs
+MIN_ID, MAX_ID = 1, 10**9 + 7
+
+# Cap on batches in flight at once
+BATCH_CONCURRENCY = 4
+
+# Rate limit: at most WINDOW_CAP batches are started per WINDOW_SECONDS window
+WINDOW_SECONDS = 5.0
+WINDOW_CAP = 8
+
+class RateLimiter:
+    # Hands out start slots at most one per `interval` seconds, measured on the monotonic clock
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_ok = float("-inf")
+
+    async def acquire(self) -> bool:
+        # Reserving has no await between read and write, so concurrent callers need no lock
+        now = time.monotonic()
+        start_time = max(now, self.next_ok)
+        self.next_ok = start_time + self.interval
+        if start_time <= now:
+            return False
+        await asyncio.sleep(start_time - now)
+        return True
+
+# Atomically flip one batch's status field and move the job's "triggered"/"completed" counters along
+# with it. KEYS[1] = ingestion:{ingestion_id}, ARGV = batch_id, status. Returns 1, or 0 if the job is gone.
+UPDATE_BATCH_LUA = """
+local key = KEYS[1]
+if redis.call('EXISTS', key) == 0 then
+    return 0
+end
+local field = 'batch:' .. ARGV[1]
+local old = redis.call('HGET', key, field)
+if old == ARGV[2] then
+    return 1
+end
+if old == 'triggered' or old == 'completed' then
+    redis.call('HINCRBY', key, old, -1)
+end
+if ARGV[2] == 'triggered' or ARGV[2] == 'completed' then
+    redis.call('HINCRBY', key, ARGV[2], 1)
+end
+redis.call('HSET', key, field, ARGV[2])
+return 1
+"""
+
+# Intake persistence: jobs stored per pipeline, retry delay after a failed write, and how long
+# readers wait for a pending job
+PERSIST_BATCH_CAP = 64
+PERSIST_RETRY_SECONDS = 1.0
+PERSIST_WAIT_SECONDS = 5.0
+
 # Global variables
-job_queue = asyncio.PriorityQueue()
-processing_lock = asyncio.Lock()
-last_processed_time = 0
-background_task = None
+batch_queue = asyncio.PriorityQueue()  # (priority_value, seq, batch, job)
+_seq = itertools.count()  # FIFO tie-breaker so equal priorities never compare batches
+batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+window_limiter = RateLimiter(WINDOW_SECONDS)
+intake_queue = asyncio.Queue()  # (ingestion_id, ids, priority, created_time) awaiting persistence
+pending_jobs: Dict[str, asyncio.Event] = {}  # Accepted ingestion ids not yet persisted to Redis
+background_tasks = []
+redis_client = None
+update_batch_script = None
+status_events: Dict[str, asyncio.Event] = {}  # Set (and dropped) on the next status change of a job
+status_waiters: Dict[str, int] = {}  # Long-poll requests currently waiting on each job
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global background_task
-    background_task = asyncio.create_task(process_jobs())
+    global background_tasks, redis_client, update_batch_script
+    # Redis connection: callers wait for a free pooled connection instead of opening new ones
+    pool = aioredis.BlockingConnectionPool(
+        host='localhost', port=6379, db=0, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS
+    )
+    redis_client = aioredis.Redis.from_pool(pool)
+    # Called via EVALSHA; reloaded automatically if the server's script cache is flushed
+    update_batch_script = redis_client.register_script(UPDATE_BATCH_LUA)
+    background_tasks = [asyncio.create_task(persist_jobs()), asyncio.create_task(process_jobs())]
     yield
-    if background_task:
-        background_task.cancel()
-        try:
-            await background_task
-        except asyncio.CancelledError:
-            pass
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await redis_client.aclose()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
-# Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+def get_redis() -> aioredis.Redis:
+    return redis_client
 
 class Priority(str, Enum):
     HIGH = "HIGH"
     MEDIUM = "MEDIUM"
     LOW = "LOW"
 
-    def get_value(self) -> int:
-        if self == Priority.HIGH:
-            return 0
-        elif self == Priority.MEDIUM:
-            return 1
-        return 2
+# Queue ordering per priority (lower value = higher priority)
+PRIORITY_VALUE = {Priority.HIGH: 0, Priority.MEDIUM: 1, Priority.LOW: 2}
 
 class IngestionRequest(BaseModel):
     ids: List[int] = Field(..., description="List of IDs to process")
@@ -54,123 +123,277 @@ class BatchStatus(str, Enum):
     TRIGGERED = "triggered"
     COMPLETED = "completed"
 
-class Batch:
-    def __init__(self, batch_id: str, ids: List[int], status: BatchStatus = BatchStatus.YET_TO_START):
-        self.batch_id = batch_id
-        self.ids = ids
-        self.status = status
+# Progress order of statuses, used to answer "has the job reached at least X"
+STATUS_RANK = {BatchStatus.YET_TO_START: 0, BatchStatus.TRIGGERED: 1, BatchStatus.COMPLETED: 2}
 
-    def to_dict(self):
-        return {
-            "batch_id": self.batch_id,
-            "ids": self.ids,
-            "status": self.status
-        }
+def overall_status(total: int, completed: int, triggered: int) -> BatchStatus:
+    if completed == total:
+        return BatchStatus.COMPLETED
+    elif triggered or completed:
+        # Batches start window by window, so a partly completed job is in flight even between windows
+        return BatchStatus.TRIGGERED
+    return BatchStatus.YET_TO_START
+
+class Batch(msgspec.Struct):
+    batch_id: str
+    ids: List[int]
+    status: BatchStatus = BatchStatus.YET_TO_START
+
+class IngestionStatus(msgspec.Struct):
+    # Wire format of /status, encoded straight to JSON without intermediate dicts
+    ingestion_id: str
+    status: BatchStatus
+    batches: List[Batch]
 
 class IngestionJob:
+    __slots__ = ('ingestion_id', 'ids', 'priority', 'priority_value', 'created_time', 'batches',
+                 '_completed', '_triggered')
+
     def __init__(self, ingestion_id: str, ids: List[int], priority: Priority, created_time: float):
         self.ingestion_id = ingestion_id
         self.ids = ids
         self.priority = priority
+        self.priority_value = PRIORITY_VALUE[priority]
         self.created_time = created_time
         self.batches = []
+        # Batch status counts, kept current by mark_batch so the overall status is O(1)
+        self._completed = 0
+        self._triggered = 0
         self._create_batches()
 
     def _create_batches(self):
-        for i in range(0, len(self.ids), 3):
-            batch_ids = self.ids[i:i+3]
-            batch = Batch(str(uuid.uuid4()), batch_ids)
-            self.batches.append(batch)
-
-    def to_dict(self):
-        return {
-            "ingestion_id": self.ingestion_id,
-            "status": self.get_overall_status(),
-            "batches": [batch.to_dict() for batch in self.batches]
+        ids = self.ids
+        self.batches = [Batch(uuid.uuid4().hex, ids[i:i+3]) for i in range(0, len(ids), 3)]
+
+    def to_hash(self) -> Dict[str, Union[bytes, str]]:
+        # Redis HASH layout: static job data under "meta", batch status counters (so the overall
+        # status can be read without the batches), and one small status field per batch
+        fields = {
+            "meta": orjson.dumps({
+                "priority": self.priority,
+                "created_time": self.created_time,
+                "batches": [[batch.batch_id, batch.ids] for batch in self.batches]
+            }),
+            **self.counters()
         }
+        for batch in self.batches:
+            fields[f"batch:{batch.batch_id}"] = batch.status
+        return fields
+
+    def _count(self, status: BatchStatus, delta: int):
+        if status == BatchStatus.COMPLETED:
+            self._completed += delta
+        elif status == BatchStatus.TRIGGERED:
+            self._triggered += delta
+
+    def mark_batch(self, batch: Batch, status: BatchStatus):
+        self._count(batch.status, -1)
+        batch.status = status
+        self._count(status, 1)
+
+    def counters(self) -> Dict[str, int]:
+        return {"total": len(self.batches), "completed": self._completed, "triggered": self._triggered}
+
+    def get_overall_status(self) -> BatchStatus:
+        return overall_status(len(self.batches), self._completed, self._triggered)
+
+async def process_batch(job: IngestionJob, batch: Batch):
+    async with batch_semaphore:
+        await asyncio.sleep(1)  # Simulate API delay
+    job.mark_batch(batch, BatchStatus.COMPLETED)
+    await update_redis_status(job, batch)
+
+async def update_redis_status(job: IngestionJob, batch: Batch):
+    # One round trip: the single-field HSET and counter moves run atomically inside Redis
+    if await update_batch_script(keys=[f"ingestion:{job.ingestion_id}"], args=[batch.batch_id, batch.status]):
+        notify_status_change(job.ingestion_id)
+
+async def trigger_batches(items: List[tuple]):
+    # Mark a window's batches triggered in one pipeline; the update script keeps the job counters in Redis
+    ingestion_ids = set()
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for _, _, batch, job in items:
+                job.mark_batch(batch, BatchStatus.TRIGGERED)
+                await update_batch_script(
+                    keys=[f"ingestion:{job.ingestion_id}"], args=[batch.batch_id, batch.status], client=pipe
+                )
+                ingestion_ids.add(job.ingestion_id)
+            await pipe.execute()
+    except Exception:
+        # Nothing was started: undo the marks and hand the window back to the queue in its original order.
+        # Any field the script did flip is flipped again, idempotently, when the batch is retried.
+        for item in items:
+            _, _, batch, job = item
+            job.mark_batch(batch, BatchStatus.YET_TO_START)
+            batch_queue.put_nowait(item)
+        raise
+
+    for ingestion_id in ingestion_ids:
+        notify_status_change(ingestion_id)
 
-    def get_overall_status(self) -> str:
-        statuses = [batch.status for batch in self.batches]
-        if all(status == BatchStatus.COMPLETED for status in statuses):
-            return BatchStatus.COMPLETED
-        elif any(status == BatchStatus.TRIGGERED for status in statuses):
-            return BatchStatus.TRIGGERED
-        return BatchStatus.YET_TO_START
-
-    def __lt__(self, other):
-        # Priority comparison (lower value = higher priority)
-        if self.priority.get_value() != other.priority.get_value():
-            return self.priority.get_value() < other.priority.get_value()
-        return self.created_time < other.created_time
-
-async def process_batch(batch: Batch):
-    await asyncio.sleep(1)  # Simulate API delay
-    batch.status = BatchStatus.COMPLETED
-    await update_redis_status(batch)
-
-async def update_redis_status(batch: Batch):
-    for key in redis_client.keys("ingestion:*"):
-        job_data = json.loads(redis_client.get(key))
-        for b in job_data["batches"]:
-            if b["batch_id"] == batch.batch_id:
-                b["status"] = batch.status
-                redis_client.set(key, json.dumps(job_data))
-                return
+def notify_status_change(ingestion_id: str):
+    # Wake long-poll waiters; the next waiter registers a fresh event
+    event = status_events.pop(ingestion_id, None)
+    if event:
+        event.set()
 
 async def process_jobs():
     while True:
         try:
-            async with processing_lock:
-                global last_processed_time
-                current_time = time.time()
+            # Reserve the window only once there is work, so an idle dispatcher never holds a stale slot
+            item = await batch_queue.get()
+            if await window_limiter.acquire():
+                # Higher priority batches may have been queued while waiting for the window
+                batch_queue.put_nowait(item)
+                item = batch_queue.get_nowait()
 
-                if current_time - last_processed_time < 5:
-                    await asyncio.sleep(5 - (current_time - last_processed_time))
+            # Start up to WINDOW_CAP of the highest priority batches in this window
+            items = [item]
+            while len(items) < WINDOW_CAP and not batch_queue.empty():
+                items.append(batch_queue.get_nowait())
 
-                if not job_queue.empty():
-                    _, job = await job_queue.get()
-                    for batch in job.batches:
-                        batch.status = BatchStatus.TRIGGERED
-                        await update_redis_status(batch)
-                        await process_batch(batch)
-                    last_processed_time = time.time()
-                else:
-                    await asyncio.sleep(0.1)
+            await trigger_batches(items)
+            await asyncio.gather(*(process_batch(job, batch) for _, _, batch, job in items))
         except asyncio.CancelledError:
             break
         except Exception as e:
             print(f"Error in process_jobs: {e}")
             await asyncio.sleep(1)
 
+async def write_jobs(jobs: List[IngestionJob]):
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for job in jobs:
+            pipe.hset(f"ingestion:{job.ingestion_id}", mapping=job.to_hash())
+        await pipe.execute()
+
+async def persist_jobs():
+    while True:
+        try:
+            # Build and store up to PERSIST_BATCH_CAP accepted requests with one pipeline
+            items = [await intake_queue.get()]
+            while len(items) < PERSIST_BATCH_CAP and not intake_queue.empty():
+                items.append(intake_queue.get_nowait())
+
+            try:
+                jobs = [
+                    IngestionJob(ingestion_id=ingestion_id, ids=ids, priority=priority, created_time=created_time)
+                    for ingestion_id, ids, priority, created_time in items
+                ]
+
+                # These ids were already handed out by /ingest, so ride out Redis outages until the write lands
+                while True:
+                    try:
+                        await write_jobs(jobs)
+                        break
+                    except (RedisConnectionError, RedisTimeoutError) as e:
+                        print(f"Error in persist_jobs, retrying: {e}")
+                        await asyncio.sleep(PERSIST_RETRY_SECONDS)
+
+                # ✅ Put (priority_value, seq, batch, job) into PriorityQueue for every batch
+                for job in jobs:
+                    for batch in job.batches:
+                        batch_queue.put_nowait((job.priority_value, next(_seq), batch, job))
+            except Exception as e:
+                # Not transient: drop this group rather than stall intake behind it
+                print(f"Error in persist_jobs, dropping {len(items)} job(s): {e}")
+            finally:
+                # Release readers waiting on these ids; dropped ones read as not found
+                for ingestion_id, *_ in items:
+                    event = pending_jobs.pop(ingestion_id, None)
+                    if event:
+                        event.set()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"Error in persist_jobs: {e}")
+            await asyncio.sleep(1)
+
 @app.post("/ingest")
 async def ingest_data(request: IngestionRequest):
-    for id in request.ids:
-        if not 1 <= id <= 10**9 + 7:
-            raise HTTPException(status_code=400, detail=f"Invalid ID: {id}. Must be between 1 and 10^9+7")
+    ids = request.ids
+    if ids and (min(ids) < MIN_ID or max(ids) > MAX_ID):
+        invalid_id = next(id for id in ids if not MIN_ID <= id <= MAX_ID)
+        raise HTTPException(status_code=400, detail=f"Invalid ID: {invalid_id}. Must be between {MIN_ID} and {MAX_ID}")
 
+    # Batch creation and persistence happen in persist_jobs; the request path only allocates the id
     ingestion_id = str(uuid.uuid4())
-    job = IngestionJob(
-        ingestion_id=ingestion_id,
-        ids=request.ids,
-        priority=request.priority,
-        created_time=time.time()
-    )
-
-    redis_client.set(f"ingestion:{ingestion_id}", json.dumps(job.to_dict()))
-    
-    # ✅ Put (priority_value, job) into PriorityQueue
-    await job_queue.put((job.priority.get_value(), job))
+    pending_jobs[ingestion_id] = asyncio.Event()
+    intake_queue.put_nowait((ingestion_id, ids, request.priority, time.time()))
 
     return {"ingestion_id": ingestion_id}
 
-@app.get("/status/{ingestion_id}")
-async def get_status(ingestion_id: str):
-    job_data = redis_client.get(f"ingestion:{ingestion_id}")
+async def wait_until_persisted(ingestion_id: str):
+    # Read-your-writes for ids handed out by /ingest but not yet stored
+    event = pending_jobs.get(ingestion_id)
+    if event:
+        try:
+            await asyncio.wait_for(event.wait(), PERSIST_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=503, detail="Ingestion job is not stored yet", headers={"Retry-After": "1"}
+            )
+
+async def load_status(redis: aioredis.Redis, ingestion_id: str) -> IngestionStatus:
+    await wait_until_persisted(ingestion_id)
+    job_data = await redis.hgetall(f"ingestion:{ingestion_id}")
     if not job_data:
         raise HTTPException(status_code=404, detail="Ingestion job not found")
 
-    return json.loads(job_data)
+    # Batch layout comes from meta, statuses from their fields, the overall status from the stored counters
+    meta = orjson.loads(job_data["meta"])
+    batches = [
+        Batch(batch_id, batch_ids, BatchStatus(job_data[f"batch:{batch_id}"]))
+        for batch_id, batch_ids in meta["batches"]
+    ]
+    status = overall_status(int(job_data["total"]), int(job_data["completed"]), int(job_data["triggered"]))
+    return IngestionStatus(ingestion_id, status, batches)
+
+def status_response(status: IngestionStatus) -> Response:
+    return Response(content=msgspec.json.encode(status), media_type="application/json")
+
+@app.get("/status/{ingestion_id}")
+async def get_status(ingestion_id: str, redis: aioredis.Redis = Depends(get_redis)):
+    return status_response(await load_status(redis, ingestion_id))
+
+@app.get("/status/{ingestion_id}/wait")
+async def wait_status(
+    ingestion_id: str,
+    until: BatchStatus = BatchStatus.COMPLETED,
+    timeout: float = Query(30, gt=0, le=60),
+    redis: aioredis.Redis = Depends(get_redis)
+):
+    # Long-poll: answer once the overall status reaches `until`, or with the latest status on timeout
+    deadline = time.monotonic() + timeout
+    await wait_until_persisted(ingestion_id)
+    status_waiters[ingestion_id] = status_waiters.get(ingestion_id, 0) + 1
+    try:
+        while True:
+            # Register before reading so a change landing between the read and the wait is not missed
+            event = status_events.setdefault(ingestion_id, asyncio.Event())
+            # Only the counters are read while waiting; the full job is loaded once, for the answer
+            counts = await redis.hmget(f"ingestion:{ingestion_id}", "total", "completed", "triggered")
+            if counts[0] is None:
+                raise HTTPException(status_code=404, detail="Ingestion job not found")
+
+            status = overall_status(*map(int, counts))
+            remaining = deadline - time.monotonic()
+            if STATUS_RANK[status] >= STATUS_RANK[until] or remaining <= 0:
+                return status_response(await load_status(redis, ingestion_id))
+
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # The last waiter out drops the job's event, however it returned, so idle jobs leave nothing behind
+        waiters = status_waiters.pop(ingestion_id) - 1
+        if waiters:
+            status_waiters[ingestion_id] = waiters
+        else:
+            status_events.pop(ingestion_id, None)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    # Single process: the job queue and workers live in this process's memory
+    uvicorn.run(app, host="0.0.0.0", port=5000, loop="uvloop", http="httptools", workers=1)